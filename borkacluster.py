@@ -1,19 +1,25 @@
 from __future__ import print_function
 import base64
-import boto3
 from datetime import datetime, timedelta
-import ipaddress
-import IPython
+import gzip
+import hashlib
+import io
 from itertools import count
 import json
-from numpy import ceil, finfo, log2, mean, median, percentile, std
+from multiprocessing.pool import ThreadPool
 import os
 from random import choice
 import re
-import requests
+try:
+	from shlex import quote
+except ImportError:
+	from pipes import quote
+import socket
 import subprocess
 import sys
 import time
+## boto3, IPython, numpy and requests are imported by the functions that need them,
+## so that command line calls like `python borkacluster.py status` start fast.
 
 region_to_region = {'us-east-1':'US East (N. Virginia)', 
 		'us-east-2':'US East (Ohio)', 
@@ -33,6 +39,8 @@ region_to_region = {'us-east-1':'US East (N. Virginia)',
 		'us-gov-west-1':'AWS GovCloud (US)' 
 		}				
 
+pricing_url_prefix = 'https://pricing.us-east-1.amazonaws.com'
+
 cx_fleet_weight = {'c3.large': 2.0, 'c3.xlarge': 4.0, 'c3.2xlarge': 8.0, 'c3.4xlarge': 16.0, 'c3.8xlarge': 32.0,
 		   'c4.large': 2.0, 'c4.xlarge': 4.0, 'c4.2xlarge': 8.0, 'c4.4xlarge': 16.0, 'c4.8xlarge': 36.0
 		   }
@@ -62,9 +70,12 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 	Usually the most expansive/vCPU OnDemand instances in a region will either be c3.large or c4.large.
 
 	The controller node will run a startup script given by the template in ipcontroller_config.sh
-	The same goes for engine instances with ipengine_config.sh
-	You may want to modify the latter in order to install more than a bare miniconda environment on engine instances.
+	The same goes for engine instances with ipengine_config.sh. Both start the ipengine_telemetry.py agent (in --hub mode on the controller)
+	You may want to modify ipengine_config.sh in order to install more than a bare miniconda environment on engine instances.
 	"""
+	import boto3
+	import ipaddress
+	from numpy import ceil, log2
 
 	if bid_style == 'cheap':
 		pass
@@ -73,7 +84,7 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 	else:
 		raise Exception('Bid style must be either \'cheap\' or \'automatic\'.')
 
-	print('Borking cluster: ' + cluster_name + ' (' + target_number_of_cores + ' vCPU)')
+	print('Borking cluster: ' + cluster_name + ' (' + str(target_number_of_cores) + ' vCPU)')
 	print('-'*60)
 
 	cluster = dict()
@@ -287,10 +298,13 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 	### Generating controller start-up script. This will only run once following instance creation
 	with open('ipcontroller_config.sh', 'r') as f:
 		controller_startup_script = f.read()
+	with open('ipengine_telemetry.py', 'r') as f:
+		telemetry_agent = f.read()
 	controller_startup_script = controller_startup_script.format(ebsdata_device=ebsdata_device, 
 																 ebsdata_mount_point=ebsdata_mount_point, 
 																 network_prefix=network_prefix,
-																 cluster_name=cluster_name)
+																 cluster_name=cluster_name,
+																 telemetry_agent=telemetry_agent)
 
 	controller_instance = ec2.run_instances(ImageId=ami_linux_id, KeyName=key_name, 
 											MinCount=1, MaxCount=1,
@@ -343,11 +357,11 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 	else:
 		print('using simplified_price_list.json...', end='')
 		with open('simplified_price_list.json', 'r') as f:
-			simplificed_price_list = json.load(f)
+			simplified_price_list = json.load(f)
 	print('done')
 
 	print('Interrogating bid advisor...', end='')
-	max_bid_advice, bid_advices = generate_spot_bid_per_vcpu(cx_fleet_weight, simplificed_price_list, cluster_region, bid_style=bid_style, cheap_factor=cheap_factor)
+	max_bid_advice, bid_advices = generate_spot_bid_per_vcpu(cx_fleet_weight, simplified_price_list, cluster_region, bid_style=bid_style, cheap_factor=cheap_factor)
 	print('done')
 	print('\tMax spot price bid: ' + max_bid_advice)
 	for inst, spot in sorted(bid_advices.iteritems(), key=lambda x: x[1]):
@@ -361,7 +375,8 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 		engine_startup_script = f.read()
 	engine_startup_script = engine_startup_script.format(ebsdata_mount_point=ebsdata_mount_point, 
 														 controller_ip=controller_private_ip,
-														 cluster_name=cluster_name)
+														 cluster_name=cluster_name,
+														 telemetry_agent=telemetry_agent)
 
 
 	with open(cluster_name + '_ClusterResources.json', 'w') as f:
@@ -419,7 +434,7 @@ def create_cluster(cluster_name='bork', target_number_of_cores=8, bid_style='che
 
 	return cluster
 
-def setup_local_ipcluster_profile(resources_file_or_dict):
+def _load_cluster_resources(resources_file_or_dict):
 	if type(resources_file_or_dict) == str:
 		with open(resources_file_or_dict, 'r') as f:
 			cluster = json.load(f)
@@ -429,30 +444,925 @@ def setup_local_ipcluster_profile(resources_file_or_dict):
 		cluster = resources_file_or_dict
 	else:
 		raise Exception(resources_file_or_dict + ' doesn\'t look like anything to me.')
+	return cluster
 
-	if not cluster.has_key('local_keypair_file'):
-		local_keypair_file = os.getcwd() + '/' + cluster['keypair_name'] + '.pem'
-	else:
-		local_keypair_file = cluster['local_keypair_file']
+def _save_cluster_resources(resources_file_or_dict, cluster):
+	## State added after creation (e.g. SSH forwards) must survive callers that pass the resources file around.
+	if type(resources_file_or_dict) == str:
+		with open(resources_file_or_dict, 'w') as f:
+			json.dump(cluster, f, indent=1)
+
+def _local_security_path(cluster):
+	import IPython
+	return '{ipython_path}/profile_{cluster_name}/security/'.format(ipython_path=IPython.paths.get_ipython_dir(), cluster_name=cluster['name'])
+
+def setup_local_ipcluster_profile(resources_file_or_dict):
+	''' Fetch ipcontroller-client.json from the controller into the local IPython profile_<cluster name>.'''
+	cluster = _load_cluster_resources(resources_file_or_dict)
 
-	local_security_path = '{ipython_path}/profile_{cluster_name}/security/'.format(ipython_path=IPython.paths.get_ipython_dir(), cluster_name=cluster['name'])
+	local_security_path = _local_security_path(cluster)
 	remote_security_file = '{ebsdata_mount_point}/profile_{cluster_name}/security/ipcontroller-client.json'.format(ebsdata_mount_point=cluster['ebsdata']['mount_point'], cluster_name=cluster['name'])
 	
-	os.makedirs(local_security_path)
+	if not os.path.isdir(local_security_path):
+		os.makedirs(local_security_path)
 	
-	subprocess.call('scp -oStrictHostKeyChecking=no -i {local_keypair_file} ec2-user@{controller_public_ip}:{remote_security_file} {local_security_path}'.format(local_keypair_file=local_keypair_file, controller_public_ip=cluster['controller_public_ip'], remote_security_file=remote_security_file, local_security_path=local_security_path), shell=True)
+	fetch_controller_file(cluster, remote_security_file, local_security_path)
+
+	return local_security_path + 'ipcontroller-client.json'
+
+
+### Persistent SSH transport
+### A single OpenSSH ControlMaster connection per cluster carries every scp
+### and every hub port forward, so only the first call pays the SSH handshake.
+ssh_control_persist = '4h'
+hub_port_keys = ('registration', 'control', 'mux', 'task', 'iopub', 'notification', 'hb_ping', 'hb_pong')
+
+def _ssh_control_path(cluster):
+	## The control socket hands out authenticated sessions to whoever can connect to it,
+	## so it lives in a directory only we can enter rather than in the shared temp dir.
+	control_dir = os.path.expanduser('~/.ssh/borkacluster')
+	if not os.path.isdir(control_dir):
+		os.makedirs(control_dir, 0o700)
+	st = os.stat(control_dir)
+	if st.st_uid != os.getuid() or st.st_mode & 0o077:
+		raise Exception(control_dir + ' must be owned by you and not accessible to anyone else (chmod 700).')
+	return os.path.join(control_dir, cluster['name'] + '_' + cluster['controller_public_ip'])
+
+def _ssh_options(cluster):
+	if not 'local_keypair_file' in cluster:
+		local_keypair_file = os.getcwd() + '/' + cluster['keypair_name'] + '.pem'
+	else:
+		local_keypair_file = cluster['local_keypair_file']
+
+	return ('-oStrictHostKeyChecking=no -oControlMaster=auto -oControlPath={control_path} -oControlPersist={control_persist} '
+			'-oServerAliveInterval=15 -oServerAliveCountMax=3 -i {local_keypair_file}').format(control_path=_ssh_control_path(cluster), 
+																							   control_persist=ssh_control_persist, 
+																							   local_keypair_file=local_keypair_file)
+
+def _ssh_control(cluster, command, extra=''):
+	with open(os.devnull, 'w') as devnull:
+		return subprocess.call('ssh {ssh_options} -O {command} {extra} ec2-user@{controller_public_ip}'.format(ssh_options=_ssh_options(cluster), 
+																												command=command, 
+																												extra=extra, 
+																												controller_public_ip=cluster['controller_public_ip']), 
+								shell=True, stdout=devnull, stderr=devnull)
+
+def open_ssh_transport(resources_file_or_dict, forward_hub_ports=True):
+	''' Open (or reuse) the persistent SSH master connection to the controller.
+
+	With forward_hub_ports=True the controller's ipcontroller-client.json is fetched,
+	every hub port is forwarded through the master connection to 127.0.0.1 and a
+	tunneled copy ipcontroller-client-tunneled.json is written next to it in the local
+	profile_<cluster name>. Pass the returned path to ipyparallel.Client without sshserver.
+	'''
+	cluster = _load_cluster_resources(resources_file_or_dict)
+
+	print('Opening SSH transport to controller ' + cluster['controller_public_ip'] + '...', end='')
+	if _ssh_control(cluster, 'check') == 0:
+		print('already open...', end='')
+	else:
+		ret = subprocess.call('ssh {ssh_options} -MNf ec2-user@{controller_public_ip}'.format(ssh_options=_ssh_options(cluster), 
+																							  controller_public_ip=cluster['controller_public_ip']), shell=True)
+		if ret != 0:
+			raise Exception('Could not open SSH master connection to ' + cluster['controller_public_ip'] + '.')
+	cluster['ssh_control_path'] = _ssh_control_path(cluster)
+	print('done')
+
+	if not forward_hub_ports:
+		return None
+
+	## Forget the forwards of a previous session before fetching the client file: the health check
+	## in fetch_controller_file would otherwise drop this master to restore ports the hub may no longer use.
+	previous_forwards = cluster.pop('ssh_forwarded_ports', None)
+	client_file = setup_local_ipcluster_profile(cluster)
+	with open(client_file, 'r') as f:
+		client_config = json.load(f)
+
+	print('Forwarding hub ports...', end='')
+	hub_ip = client_config['interface'].split('://')[-1]
+	forwarded_ports = []
+	for key in hub_port_keys:
+		ports = client_config.get(key, [])
+		if type(ports) != list:
+			ports = [ports]
+		forwarded_ports.extend(ports)
+	forwarded_ports = sorted(set(forwarded_ports))
+	if previous_forwards is not None:
+		for port in previous_forwards['ports']:
+			if not port in forwarded_ports or previous_forwards['hub_ip'] != hub_ip:
+				_ssh_control(cluster, 'cancel', '-L 127.0.0.1:{port}:{hub_ip}:{port}'.format(port=port, hub_ip=previous_forwards['hub_ip']))
+	_forward_ports(cluster, hub_ip, forwarded_ports)
+	cluster['ssh_forwarded_ports'] = {'hub_ip':hub_ip, 'ports':forwarded_ports}
+	_save_cluster_resources(resources_file_or_dict, cluster)
+	print('done')
+
+	client_config['interface'] = 'tcp://127.0.0.1'
+	client_config['location'] = '127.0.0.1'
+	client_config['ssh'] = ''
+	tunneled_client_file = _local_security_path(cluster) + 'ipcontroller-client-tunneled.json'
+	with open(tunneled_client_file, 'w') as f:
+		json.dump(client_config, f, indent=1)
+
+	return tunneled_client_file
+
+def _forward_ports(cluster, hub_ip, ports):
+	for port in ports:
+		print(str(port) + '...', end='')
+		ret = _ssh_control(cluster, 'forward', '-L 127.0.0.1:{port}:{hub_ip}:{port}'.format(port=port, hub_ip=hub_ip))
+		if ret != 0:
+			raise Exception('Could not forward hub port ' + str(port) + ' (already in use locally?).')
+
+def ssh_transport_alive(resources_file_or_dict, timeout=2.0):
+	''' Health check: the master connection answers and ssh still listens on every forwarded hub port.
+
+	Connecting to a forward only reaches ssh's local listener, so this catches a master that was
+	restarted without its forwards, not a hub that stopped answering on the controller.
+	'''
+	cluster = _load_cluster_resources(resources_file_or_dict)
+
+	if _ssh_control(cluster, 'check') != 0:
+		return False
+
+	for port in cluster.get('ssh_forwarded_ports', {}).get('ports', []):
+		try:
+			s = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+			s.close()
+		except socket.error:
+			return False
+
+	return True
+
+def ensure_ssh_transport(resources_file_or_dict):
+	''' Reconnect the SSH master connection and restore its hub port forwards if the health check fails.'''
+	cluster = _load_cluster_resources(resources_file_or_dict)
+
+	if ssh_transport_alive(cluster):
+		return cluster
+
+	if 'ssh_control_path' in cluster:
+		print('SSH transport to ' + cluster['controller_public_ip'] + ' is down, reconnecting...', end='')
+		## A wedged master still holds the control socket, tell it to leave first.
+		_ssh_control(cluster, 'exit')
+	open_ssh_transport(cluster, forward_hub_ports=False)
+	if 'ssh_forwarded_ports' in cluster:
+		print('Restoring hub port forwards...', end='')
+		_forward_ports(cluster, cluster['ssh_forwarded_ports']['hub_ip'], cluster['ssh_forwarded_ports']['ports'])
+		print('done')
+
+	return cluster
+
+def close_ssh_transport(resources_file_or_dict):
+	cluster = _load_cluster_resources(resources_file_or_dict)
+
+	print('Closing SSH transport to controller ' + cluster['controller_public_ip'] + '...', end='')
+	if _ssh_control(cluster, 'exit') != 0:
+		print('(not open)...', end='')
+	cluster.pop('ssh_forwarded_ports', None)
+	_save_cluster_resources(resources_file_or_dict, cluster)
+	print('done')
+
+def fetch_controller_file(resources_file_or_dict, remote_path, local_path):
+	''' scp remote_path from the controller to local_path over the persistent SSH master connection.'''
+	cluster = ensure_ssh_transport(resources_file_or_dict)
+
+	ret = subprocess.call('scp {ssh_options} ec2-user@{controller_public_ip}:{remote_path} {local_path}'.format(ssh_options=_ssh_options(cluster), 
+																											   controller_public_ip=cluster['controller_public_ip'], 
+																											   remote_path=remote_path, 
+																											   local_path=local_path), shell=True)
+	if ret != 0:
+		raise Exception('Could not fetch ' + remote_path + ' from controller.')
+
+	return local_path
+
+def _round_trip_noop():
+	return None
+## Engines don't have this module, tell ipyparallel to ship the function's code instead of a reference to
+## borkacluster._round_trip_noop (this is what ipyparallel.interactive does).
+_round_trip_noop.__module__ = '__main__'
+
+def benchmark_round_trip_latency(resources_file_or_dict, nb_tasks=100, compare_sshserver=False):
+	''' Time submit->result round-trips of a no-op task through the load balanced view.
+
+	The client goes through the persistent SSH transport (open_ssh_transport). With compare_sshserver=True
+	the same benchmark is repeated with ipyparallel's own sshserver tunnels for reference.
+	Returns a dict of {transport: [latencies in seconds]}.
+	'''
+	from ipyparallel import Client
+	from numpy import mean, median, percentile, std
+
+	cluster = _load_cluster_resources(resources_file_or_dict)
+
+	t0 = time.time()
+	tunneled_client_file = open_ssh_transport(cluster)
+	clients = [('ssh_transport', t0, lambda: Client(tunneled_client_file))]
+	if compare_sshserver:
+		local_keypair_file = cluster.get('local_keypair_file', os.getcwd() + '/' + cluster['keypair_name'] + '.pem')
+		clients.append(('sshserver', None, lambda: Client(_local_security_path(cluster) + 'ipcontroller-client.json', 
+														  sshserver='ec2-user@' + cluster['controller_public_ip'], 
+														  sshkey=local_keypair_file)))
+
+	latencies = dict()
+	for transport, t0, make_client in clients:
+		if t0 is None:
+			t0 = time.time()
+		client = make_client()
+		lbv = client.load_balanced_view()
+		lbv.apply_sync(_round_trip_noop)
+		connect_time = time.time() - t0
+
+		latencies[transport] = []
+		for i in range(nb_tasks):
+			t = time.time()
+			lbv.apply_sync(_round_trip_noop)
+			latencies[transport].append(time.time() - t)
+		client.close()
+
+		print(transport + ' (' + str(nb_tasks) + ' tasks)')
+		print('\t' + 'Connect + first task'.rjust(20) + ': ' + str(round(connect_time, 4)) + 's')
+		print('\t' + 'Mean round-trip'.rjust(20) + ': ' + str(round(mean(latencies[transport])*1000, 2)) + 'ms (std ' + str(round(std(latencies[transport])*1000, 2)) + 'ms)')
+		print('\t' + 'Median round-trip'.rjust(20) + ': ' + str(round(median(latencies[transport])*1000, 2)) + 'ms')
+		print('\t' + '95th percentile'.rjust(20) + ': ' + str(round(percentile(latencies[transport], 95)*1000, 2)) + 'ms')
+
+	return latencies
+
+
+### Data staging to and from the controller's NFS volume
+### Files are split in chunk_size pieces streamed in parallel through the SSH transport
+### (one dd per chunk, with a 1M buffer). A manifest of content hashes lives at the root of the staged
+### directory on each side so unchanged files are skipped and interrupted transfers resume.
+staging_manifest_name = '.borkacluster_manifest.json'
+staging_chunk_size = 64*2**20
+
+def _run_remote(cluster, command, data=None):
+	p = subprocess.Popen('ssh {ssh_options} ec2-user@{controller_public_ip} {command}'.format(ssh_options=_ssh_options(cluster), 
+																							 controller_public_ip=cluster['controller_public_ip'], 
+																							 command=quote(command)), 
+						 shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = p.communicate(data)
+	if p.returncode != 0:
+		raise Exception('Remote command failed on controller (' + command + '): ' + err.decode('utf-8', 'replace').strip())
+	return out
+
+def _gzip(data):
+	buf = io.BytesIO()
+	with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as g:
+		g.write(data)
+	return buf.getvalue()
+
+def _gunzip(data):
+	with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as g:
+		return g.read()
+
+def _hash_file(path, chunk_size):
+	file_hash = hashlib.sha256()
+	chunks = []
+	size = 0
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(chunk_size)
+			if not data:
+				break
+			file_hash.update(data)
+			chunks.append(hashlib.sha256(data).hexdigest())
+			size += len(data)
+	return {'size':size, 'sha256':file_hash.hexdigest(), 'chunk_size':chunk_size, 'chunks':chunks}
+
+def _read_local_manifest(local_dir):
+	manifest_file = os.path.join(local_dir, staging_manifest_name)
+	if not os.path.isfile(manifest_file):
+		return dict()
+	with open(manifest_file, 'r') as f:
+		return json.load(f)
+
+def _write_local_manifest(local_dir, manifest):
+	manifest_file = os.path.join(local_dir, staging_manifest_name)
+	with open(manifest_file + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent=1)
+	os.rename(manifest_file + '.tmp', manifest_file)
+
+def _build_local_manifest(local_dir, chunk_size, previous_manifest):
+	''' Hash every file under local_dir, reusing previous hashes of files whose size and mtime didn't change.
+
+	Files still being downloaded (entries with 'done') keep their previous entry unhashed, their content is partial anyway.
+	'''
+	manifest = dict()
+	for root, dirs, names in os.walk(local_dir):
+		for name in names:
+			if name in (staging_manifest_name, staging_manifest_name + '.tmp'):
+				continue
+			path = os.path.join(root, name)
+			rel = os.path.relpath(path, local_dir).replace(os.sep, '/')
+			st = os.stat(path)
+			previous = previous_manifest.get(rel)
+			if previous is not None and 'done' in previous:
+				manifest[rel] = previous
+			elif (previous is not None and previous.get('chunks') is not None 
+				and previous['chunk_size'] == chunk_size and previous['size'] == st.st_size and previous.get('mtime') == st.st_mtime):
+				manifest[rel] = previous
+			else:
+				manifest[rel] = _hash_file(path, chunk_size)
+				manifest[rel]['mtime'] = st.st_mtime
+	return manifest
+
+def _remote_staging_dir(cluster, remote_dir, default_name):
+	if remote_dir is None:
+		remote_dir = default_name
+	if not remote_dir.startswith('/'):
+		remote_dir = cluster['ebsdata']['mount_point'] + '/' + remote_dir
+	return remote_dir.rstrip('/')
+
+def _read_remote_manifest(cluster, remote_dir):
+	''' Load the remote manifest and drop entries for files that vanished or changed behind its back.'''
+	manifest_file = remote_dir + '/' + staging_manifest_name
+	out = _run_remote(cluster, 'cat {manifest_file} 2>/dev/null || true'.format(manifest_file=quote(manifest_file)))
+	manifest = json.loads(out.decode('utf-8')) if out.strip() else dict()
+
+	listing = _remote_listing(cluster, remote_dir)
+	for rel, entry in list(manifest.items()):
+		if (not rel in listing or listing[rel]['size'] != entry['size'] 
+			or ('mtime' in entry and listing[rel]['mtime'] != entry['mtime'])):
+			del manifest[rel]
+
+	return manifest, listing
+
+def _write_remote_manifest(cluster, remote_dir, manifest):
+	manifest_file = quote(remote_dir + '/' + staging_manifest_name)
+	_run_remote(cluster, 'cat > {manifest_file}.tmp && mv {manifest_file}.tmp {manifest_file}'.format(manifest_file=manifest_file), 
+				json.dumps(manifest, indent=1).encode('utf-8'))
+
+def _remote_listing(cluster, remote_dir):
+	out = _run_remote(cluster, 'if cd {remote_dir} 2>/dev/null; then find . -type f ! -name {manifest_name} ! -name {manifest_name}.tmp -printf \'%s %T@ %P\\0\'; fi'.format(remote_dir=quote(remote_dir), 
+																																		  manifest_name=quote(staging_manifest_name)))
+	listing = dict()
+	for line in out.decode('utf-8').split('\0'):
+		if line:
+			size, mtime, rel = line.split(' ', 2)
+			listing[rel] = {'size':int(size), 'mtime':mtime}
+	return listing
+
+def _remote_sha256(cluster, remote_dir, sizes):
+	''' sha256 of the first sizes[rel] bytes of every rel, so files still being appended to hash as they were listed.'''
+	if not sizes:
+		return dict()
+	rels = sorted(sizes)
+	hash_script = 'cd ' + quote(remote_dir) + '\n'
+	for rel in rels:
+		hash_script += 'head -c ' + str(sizes[rel]) + ' -- ' + quote(rel) + ' | sha256sum\n'
+	out = _run_remote(cluster, 'sh', hash_script.encode('utf-8'))
+	return dict(zip(rels, [line.split()[0] for line in out.decode('utf-8').splitlines()]))
+
+def _report_throughput(direction, nb_bytes, elapsed, nb_transferred, nb_skipped):
+	print('\t' + direction + ' ' + str(round(nb_bytes/2.0**20, 2)) + ' MiB in ' + str(round(elapsed, 2)) + 's (' 
+		  + str(round(nb_bytes/2.0**20/max(elapsed, 1e-9), 2)) + ' MiB/s), ' 
+		  + str(nb_transferred) + ' file(s) transferred, ' + str(nb_skipped) + ' unchanged file(s) skipped')
+	return {'bytes':nb_bytes, 'seconds':elapsed, 'files_transferred':nb_transferred, 'files_skipped':nb_skipped}
+
+def upload_data(resources_file_or_dict, local_dir, remote_dir=None, nb_streams=8, chunk_size=staging_chunk_size, compress=False, verify=True):
+	''' Stage local_dir onto the controller's EBS data volume (and so onto every engine's NFS mount).
+
+	Only the controller needs to be up, engines may or may not exist yet.
+	A relative remote_dir is taken relative to the EBS mount point and defaults to the basename of local_dir.
+	Files whose content hash matches the remote manifest are skipped. The remote manifest is checkpointed
+	during the transfer so an interrupted upload only resends the chunks that didn't make it.
+	nb_streams should stay below the controller sshd's MaxSessions (10 by default).
+	With compress=True every chunk is gzipped on the wire, which pays off on text-like data.
+	'''
+	cluster = ensure_ssh_transport(resources_file_or_dict)
+	local_dir = os.path.abspath(local_dir)
+	remote_dir = _remote_staging_dir(cluster, remote_dir, os.path.basename(local_dir))
+
+	print('Uploading ' + local_dir + ' --> (controller) ' + remote_dir + '...', end='')
+	print('hashing...', end='')
+	local_manifest = _build_local_manifest(local_dir, chunk_size, _read_local_manifest(local_dir))
+	_write_local_manifest(local_dir, local_manifest)
+
+	print('comparing...', end='')
+	remote_manifest, listing = _read_remote_manifest(cluster, remote_dir)
+	transfers = []
+	nb_skipped = 0
+	for rel, entry in sorted(local_manifest.items()):
+		remote_entry = remote_manifest.get(rel)
+		if remote_entry is not None and not 'done' in remote_entry and remote_entry['sha256'] == entry['sha256']:
+			nb_skipped += 1
+			continue
+		## Chunks already sent by an interrupted upload are kept if their content didn't change since.
+		done = []
+		if remote_entry is not None and 'done' in remote_entry and remote_entry['chunk_size'] == chunk_size:
+			done = [i for i in remote_entry['done'] if i < len(entry['chunks']) and remote_entry['chunks'][i] == entry['chunks'][i]]
+		remote_manifest[rel] = {'size':entry['size'], 'sha256':entry['sha256'], 'chunk_size':chunk_size, 'chunks':entry['chunks'], 'done':done}
+		transfers.extend([(rel, i) for i in range(len(entry['chunks'])) if not i in done])
+
+	pending = sorted([rel for rel, entry in remote_manifest.items() if 'done' in entry])
+	print('preparing...', end='')
+	prepare_script = 'set -e\nmkdir -p ' + quote(remote_dir) + '\ncd ' + quote(remote_dir) + '\n'
+	for rel in pending:
+		prepare_script += 'mkdir -p ' + quote(os.path.dirname(rel) or '.') + ' && truncate -s ' + str(remote_manifest[rel]['size']) + ' ' + quote(rel) + '\n'
+	_run_remote(cluster, 'sh', prepare_script.encode('utf-8'))
+	for rel in pending:
+		if len(remote_manifest[rel]['done']) == len(remote_manifest[rel]['chunks']):
+			del remote_manifest[rel]['done']
+	_write_remote_manifest(cluster, remote_dir, remote_manifest)
+
+	def upload_chunk(transfer):
+		rel, i = transfer
+		with open(os.path.join(local_dir, rel), 'rb') as f:
+			f.seek(i*chunk_size)
+			data = f.read(chunk_size)
+		nb_bytes = len(data)
+		## A small dd buffer with byte offsets, bs=chunk_size would cost every stream a chunk's worth of the controller's memory.
+		command = 'dd of={path} bs=1M oflag=seek_bytes seek={offset} conv=notrunc status=none'.format(path=quote(remote_dir + '/' + rel), offset=i*chunk_size)
+		if compress:
+			data = _gzip(data)
+			command = 'gzip -dc | ' + command
+		_run_remote(cluster, command, data)
+		return rel, i, nb_bytes
+
+	print('transferring ' + str(len(transfers)) + ' chunk(s) over ' + str(nb_streams) + ' streams...', end='')
+	nb_bytes = 0
+	t0 = last_checkpoint = time.time()
+	pool = ThreadPool(nb_streams)
+	try:
+		for rel, i, chunk_bytes in pool.imap_unordered(upload_chunk, transfers):
+			nb_bytes += chunk_bytes
+			remote_manifest[rel]['done'].append(i)
+			if len(remote_manifest[rel]['done']) == len(remote_manifest[rel]['chunks']):
+				del remote_manifest[rel]['done']
+			if time.time() - last_checkpoint > 10:
+				_write_remote_manifest(cluster, remote_dir, remote_manifest)
+				last_checkpoint = time.time()
+	finally:
+		pool.terminate()
+		_write_remote_manifest(cluster, remote_dir, remote_manifest)
+	elapsed = time.time() - t0
+
+	if verify and pending:
+		print('verifying...', end='')
+		remote_hashes = _remote_sha256(cluster, remote_dir, dict([(rel, remote_manifest[rel]['size']) for rel in pending]))
+		corrupted = [rel for rel in pending if remote_hashes.get(rel) != remote_manifest[rel]['sha256']]
+		if corrupted:
+			for rel in corrupted:
+				del remote_manifest[rel]
+			_write_remote_manifest(cluster, remote_dir, remote_manifest)
+			raise Exception('Content hash mismatch after upload, run upload_data again to resend: ' + ', '.join(corrupted))
+
+	## Stamp mtimes so files modified on the cluster afterwards are caught by later comparisons.
+	listing = _remote_listing(cluster, remote_dir)
+	for rel in pending:
+		remote_manifest[rel]['mtime'] = listing[rel]['mtime']
+	_write_remote_manifest(cluster, remote_dir, remote_manifest)
+	print('done')
+
+	return _report_throughput('Uploaded', nb_bytes, elapsed, len(pending), nb_skipped)
+
+def download_data(resources_file_or_dict, remote_dir, local_dir=None, nb_streams=8, chunk_size=staging_chunk_size, compress=False, verify=True):
+	''' Fetch remote_dir from the controller's EBS data volume into local_dir.
+
+	A relative remote_dir is taken relative to the EBS mount point, local_dir defaults to its basename.
+	Remote files are hashed on the controller only when they changed since the remote manifest last saw them.
+	Files whose content hash matches the local manifest are skipped and interrupted downloads resume chunk-wise.
+	See upload_data for nb_streams and compress.
+	'''
+	cluster = ensure_ssh_transport(resources_file_or_dict)
+	remote_dir = _remote_staging_dir(cluster, remote_dir, None)
+	if local_dir is None:
+		local_dir = os.path.basename(remote_dir)
+	local_dir = os.path.abspath(local_dir)
+	if not os.path.isdir(local_dir):
+		os.makedirs(local_dir)
+
+	print('Downloading (controller) ' + remote_dir + ' --> ' + local_dir + '...', end='')
+	print('hashing...', end='')
+	remote_manifest, listing = _read_remote_manifest(cluster, remote_dir)
+	for rel, entry in list(remote_manifest.items()):
+		if 'done' in entry:
+			print('(' + rel + ' is still being uploaded, skipped)...', end='')
+			del listing[rel]
+	unhashed = sorted([rel for rel in listing if not rel in remote_manifest])
+	for rel, sha256 in _remote_sha256(cluster, remote_dir, dict([(rel, listing[rel]['size']) for rel in unhashed])).items():
+		remote_manifest[rel] = {'size':listing[rel]['size'], 'sha256':sha256, 'mtime':listing[rel]['mtime']}
+	if unhashed:
+		_write_remote_manifest(cluster, remote_dir, remote_manifest)
+
+	local_manifest = _build_local_manifest(local_dir, chunk_size, _read_local_manifest(local_dir))
+
+	print('comparing...', end='')
+	transfers = []
+	nb_skipped = 0
+	for rel in sorted(listing):
+		remote_entry = remote_manifest[rel]
+		local_entry = local_manifest.get(rel)
+		if local_entry is not None and not 'done' in local_entry and local_entry['sha256'] == remote_entry['sha256']:
+			nb_skipped += 1
+			continue
+		done = []
+		if (local_entry is not None and 'done' in local_entry and local_entry['sha256'] == remote_entry['sha256'] 
+			and local_entry['chunk_size'] == chunk_size):
+			done = local_entry['done']
+		nb_chunks = (remote_entry['size'] + chunk_size - 1)//chunk_size
+		local_manifest[rel] = {'size':remote_entry['size'], 'sha256':remote_entry['sha256'], 'chunk_size':chunk_size, 'nb_chunks':nb_chunks, 'done':done}
+		transfers.extend([(rel, i) for i in range(nb_chunks) if not i in done])
+
+	pending = sorted([rel for rel, entry in local_manifest.items() if 'done' in entry])
+	for rel in pending:
+		path = os.path.join(local_dir, rel)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'r+b' if os.path.isfile(path) else 'wb') as f:
+			f.truncate(local_manifest[rel]['size'])
+	_write_local_manifest(local_dir, local_manifest)
+
+	def download_chunk(transfer):
+		rel, i = transfer
+		## Telemetry and other files may grow while we read them, never read past the size that was listed and hashed.
+		## Byte offsets keep dd's buffer at 1M whatever the chunk size (see upload_chunk).
+		command = 'dd if={path} bs=1M iflag=skip_bytes,count_bytes skip={offset} count={length} status=none'.format(path=quote(remote_dir + '/' + rel), offset=i*chunk_size, 
+																													   length=min(chunk_size, local_manifest[rel]['size'] - i*chunk_size))
+		if compress:
+			command += ' | gzip -1c'
+		data = _run_remote(cluster, command)
+		if compress:
+			data = _gunzip(data)
+		with open(os.path.join(local_dir, rel), 'r+b') as f:
+			f.seek(i*chunk_size)
+			f.write(data)
+		return rel, i, len(data)
+
+	print('transferring ' + str(len(transfers)) + ' chunk(s) over ' + str(nb_streams) + ' streams...', end='')
+	nb_bytes = 0
+	t0 = last_checkpoint = time.time()
+	pool = ThreadPool(nb_streams)
+	try:
+		for rel, i, chunk_bytes in pool.imap_unordered(download_chunk, transfers):
+			nb_bytes += chunk_bytes
+			local_manifest[rel]['done'].append(i)
+			if time.time() - last_checkpoint > 10:
+				_write_local_manifest(local_dir, local_manifest)
+				last_checkpoint = time.time()
+	finally:
+		pool.terminate()
+		_write_local_manifest(local_dir, local_manifest)
+	elapsed = time.time() - t0
+
+	if verify:
+		print('verifying...', end='')
+	corrupted = []
+	for rel in pending:
+		entry = local_manifest[rel]
+		if len(entry['done']) < entry['nb_chunks']:
+			continue
+		path = os.path.join(local_dir, rel)
+		if verify:
+			local_manifest[rel] = _hash_file(path, chunk_size)
+			if local_manifest[rel]['sha256'] != entry['sha256']:
+				corrupted.append(rel)
+				del local_manifest[rel]
+				continue
+		else:
+			## Not hashed locally, so no chunk hashes: the next _build_local_manifest will fill them in.
+			local_manifest[rel] = {'size':entry['size'], 'sha256':entry['sha256'], 'chunk_size':chunk_size}
+		local_manifest[rel]['mtime'] = os.stat(path).st_mtime
+	_write_local_manifest(local_dir, local_manifest)
+	if corrupted:
+		raise Exception('Content hash mismatch after download, run download_data again to refetch: ' + ', '.join(corrupted))
+	print('done')
+
+	return _report_throughput('Downloaded', nb_bytes, elapsed, len(pending), nb_skipped)
+
+### Engine-side read cache
+### engine_cached_path runs on engines: it materializes an NFS file onto the instance's local disk
+### on first access, content-addressed by sha256 so renamed or duplicated inputs are stored once,
+### and evicts least recently used objects past max_bytes. Engines don't have this module: every
+### function sent to them is marked as __main__ (what ipyparallel.interactive does) so ipyparallel
+### ships its code instead of having the engine import borkacluster, and it only references its own imports.
+engine_cache_dir = '/var/tmp/borkacluster_cache'
+engine_cache_max_bytes = 4*2**30
+
+def engine_cached_path(path, cache_dir=engine_cache_dir, max_bytes=engine_cache_max_bytes):
+	''' Return a local, read-only copy of the NFS file path, pulling it into cache_dir if needed.
+
+	An entry is invalidated when the NFS file's size or mtime changes, the content hash then comes from
+	the staging manifest written by upload_data when it still matches the file, or by hashing the copy.
+	Engines sharing an instance share the cache and a lock, so each file crosses NFS once per instance.
+	'''
+	import errno, fcntl, hashlib, json, os, shutil
+
+	path = os.path.abspath(path)
+	objects_dir = os.path.join(cache_dir, 'objects')
+	index_file = os.path.join(cache_dir, 'index.json')
+
+	def read_index():
+		try:
+			with open(index_file, 'r') as f:
+				return json.load(f)
+		except (IOError, OSError, ValueError):
+			return dict()
+
+	def manifest_sha256(st):
+		## Nearest staging manifest up the tree, if it still describes this very file.
+		directory = os.path.dirname(path)
+		while True:
+			manifest_file = os.path.join(directory, '.borkacluster_manifest.json')
+			if os.path.isfile(manifest_file):
+				try:
+					with open(manifest_file, 'r') as f:
+						entry = json.load(f).get(os.path.relpath(path, directory))
+				except ValueError:
+					entry = None
+				if (entry is not None and not 'done' in entry and entry['size'] == st.st_size 
+					and 'mtime' in entry and abs(float(entry['mtime']) - st.st_mtime) < 1e-3):
+					return entry['sha256']
+				return None
+			if directory == os.path.dirname(directory):
+				return None
+			directory = os.path.dirname(directory)
+
+	st = os.stat(path)
+	entry = read_index().get(path)
+	if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+		cached = os.path.join(objects_dir, entry['sha256'])
+		if os.path.isfile(cached):
+			os.utime(cached, None)
+			return cached
+
+	try:
+		os.makedirs(objects_dir)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+	with open(os.path.join(cache_dir, 'lock'), 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+
+		## Another engine on this instance may have pulled it while we waited for the lock.
+		index = read_index()
+		entry = index.get(path)
+		sha256 = None
+		if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+			sha256 = entry['sha256']
+		if sha256 is None:
+			sha256 = manifest_sha256(st)
+
+		if sha256 is None or not os.path.isfile(os.path.join(objects_dir, sha256)):
+			tmp = os.path.join(objects_dir, 'incoming')
+			file_hash = hashlib.sha256()
+			with open(path, 'rb') as src:
+				with open(tmp, 'wb') as dst:
+					while True:
+						data = src.read(2**20)
+						if not data:
+							break
+						file_hash.update(data)
+						dst.write(data)
+			sha256 = file_hash.hexdigest()
+			os.chmod(tmp, 0o444)
+			os.rename(tmp, os.path.join(objects_dir, sha256))
+
+		cached = os.path.join(objects_dir, sha256)
+		os.utime(cached, None)
+		index[path] = {'size':st.st_size, 'mtime':st.st_mtime, 'sha256':sha256}
+
+		## Evict least recently used objects, never the one we're about to hand out.
+		objects = [(os.stat(os.path.join(objects_dir, o)), o) for o in os.listdir(objects_dir) if o != 'incoming']
+		total = sum([s.st_size for s, o in objects])
+		for s, o in sorted(objects, key=lambda x: x[0].st_mtime):
+			if total <= max_bytes:
+				break
+			if o == sha256:
+				continue
+			os.remove(os.path.join(objects_dir, o))
+			total -= s.st_size
+		live = set([o for o in os.listdir(objects_dir)])
+		index = dict([(p, e) for p, e in index.items() if e['sha256'] in live])
+
+		with open(index_file + '.tmp', 'w') as f:
+			json.dump(index, f)
+		os.rename(index_file + '.tmp', index_file)
+
+	return cached
+engine_cached_path.__module__ = '__main__'
+
+def _engine_hostname():
+	import socket
+	return socket.gethostname()
+_engine_hostname.__module__ = '__main__'
+
+def prefetch_engine_cache(client, paths, cache_dir=engine_cache_dir, max_bytes=engine_cache_max_bytes):
+	''' Pull paths into the local cache of every engine instance and make engine_cached_path available to tasks.
+
+	Engines are grouped by instance and a single engine per instance does the pull, so a c4.8xlarge
+	running 36 engines reads each file from the controller's NFS export once instead of 36 times.
+	Engines can't reach each other through the engine security group, so there is no engine-to-engine relay:
+	the controller serves each file once per instance.
+	Returns {hostname: [local cached paths]}.
+	'''
+	if type(paths) == str:
+		paths = [paths]
+
+	print('Pushing engine_cached_path to engines...', end='')
+	dview = client[:]
+	dview.push({'engine_cached_path':engine_cached_path}, block=True)
+	print('done')
+
+	print('Finding engine instances...', end='')
+	hosts = dict()
+	for engine_id, hostname in zip(client.ids, dview.apply_sync(_engine_hostname)):
+		hosts.setdefault(hostname, []).append(engine_id)
+	print(str(len(hosts)) + ' instance(s)...done')
+
+	print('Prefetching ' + str(len(paths)) + ' file(s)...', end='')
+	## engine_cached_path resolves to the copy pushed into the engine's namespace above.
+	def pull(ps, c, m):
+		return [engine_cached_path(p, c, m) for p in ps]
+	pull.__module__ = '__main__'
+	t0 = time.time()
+	pulls = dict([(hostname, client[engine_ids[0]].apply_async(pull, paths, cache_dir, max_bytes)) 
+						for hostname, engine_ids in hosts.items()])
+	cached_paths = dict([(hostname, pull.get()) for hostname, pull in pulls.items()])
+	print('done (' + str(round(time.time() - t0, 2)) + 's)')
+
+	return cached_paths
+
+def _fetch_appended(cluster, remote_dir, local_dir):
+	''' Bring local copies of the append-only files of remote_dir up to date, fetching only the bytes past their local size.
+
+	Everything comes back in a single gzipped stream. Only complete lines are kept, so a record caught in the
+	middle of an append is fetched whole next time. Returns the number of bytes fetched.
+	'''
+	if not os.path.isdir(local_dir):
+		os.makedirs(local_dir)
+
+	listing = _remote_listing(cluster, remote_dir)
+	fetches = []
+	fetch_script = 'cd ' + quote(remote_dir) + '\n'
+	for rel in sorted(listing):
+		path = os.path.join(local_dir, rel)
+		local_size = os.path.getsize(path) if os.path.isfile(path) else 0
+		if local_size > listing[rel]['size']:
+			## Recreated on the controller, start over
+			local_size = 0
+		length = listing[rel]['size'] - local_size
+		if length > 0:
+			fetches.append((rel, local_size, length))
+			fetch_script += ('dd if=' + quote(rel) + ' bs=1M iflag=skip_bytes,count_bytes skip=' + str(local_size) 
+							 + ' count=' + str(length) + ' status=none\n')
+	if not fetches:
+		return 0
+
+	data = _gunzip(_run_remote(cluster, 'sh | gzip -1c', fetch_script.encode('utf-8')))
+	if len(data) != sum([length for rel, local_size, length in fetches]):
+		raise Exception('Files in ' + remote_dir + ' shrank while being fetched, try again.')
+
+	offset = 0
+	for rel, local_size, length in fetches:
+		chunk = data[offset:offset + length]
+		offset += length
+		path = os.path.join(local_dir, rel)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'r+b' if local_size > 0 else 'wb') as f:
+			f.seek(local_size)
+			f.write(chunk)
+			f.truncate(local_size + chunk.rfind(b'\n') + 1)
+	return len(data)
+
+def engine_utilization(resources_file_or_dict, since=None, local_dir=None, fetch=True):
+	''' Fetch the engine telemetry from the controller and summarize utilization per instance type.
+
+	Telemetry is written by the ipengine_telemetry.py agent that ipengine_config.sh starts on every engine
+	instance, under <EBS mount point>/telemetry_<cluster name>. Its files are append-only, so only what was
+	appended since the last call is fetched into local_dir (default <cluster name>_telemetry), pass fetch=False
+	to only summarize what is already there. With since (in hours) only the most recent samples are considered.
+	Returns {instance type: {metric: value}}, which is what cx_fleet_weight and target_number_of_cores
+	right-sizing should be based on. cpu_busy_engines is a CPU proxy (engines burning more than half a core),
+	the exact task counts of the whole cluster come from the hub sampler ipcontroller_config.sh starts and
+	are returned under the 'hub' key.
+	'''
+	from numpy import mean, percentile
+
+	if local_dir is None:
+		local_dir = _load_cluster_resources(resources_file_or_dict)['name'] + '_telemetry'
+
+	if fetch:
+		cluster = ensure_ssh_transport(resources_file_or_dict)
+		print('Fetching telemetry...', end='')
+		nb_bytes = _fetch_appended(cluster, _remote_staging_dir(cluster, 'telemetry_' + cluster['name'], None), local_dir)
+		print(str(round(nb_bytes/2.0**20, 2)) + ' MiB...done')
+
+	start = time.time() - since*3600 if since is not None else 0
+	samples_per_type = dict()
+	instances_per_type = dict()
+	hub_samples = []
+	for name in sorted(os.listdir(local_dir)):
+		if not name.endswith('.jsonl'):
+			continue
+		with open(os.path.join(local_dir, name), 'r') as f:
+			header = json.loads(f.readline())
+			columns = dict([(field, i) for i, field in enumerate(header['fields'])])
+			samples = []
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					## Only complete lines are fetched, but a copy made some other way may end mid-append
+					continue
+				if record[columns['t']] >= start:
+					samples.append(record)
+		if not samples:
+			continue
+		interval = float(header['interval'])
+		if header.get('hub'):
+			for record in samples:
+				value = lambda field: record[columns[field]]
+				hub_samples.append((value('engines'), float(value('busy_engines'))/max(value('engines'), 1), 
+									value('queued'), value('unassigned'), value('completed')/interval))
+			continue
+		instance_type = header['instance_type']
+		instances_per_type[instance_type] = instances_per_type.get(instance_type, 0) + 1
+		for record in samples:
+			value = lambda field: record[columns[field]]
+			samples_per_type.setdefault(instance_type, []).append(
+				(value('cpu'), float(value('mem_used'))/value('mem_total'), float(value('engine_rss'))/max(value('engines'), 1)/2**20,
+				 value('load1')/header['vcpus'], value('nfs_read')/interval/2**20, value('nfs_write')/interval/2**20,
+				 float(value('cpu_busy_engines'))/max(value('engines'), 1)))
+
+	utilization = dict()
+	for instance_type, samples in samples_per_type.items():
+		cpu, mem, rss, load, nfs_read, nfs_write, busy = [list(column) for column in zip(*samples)]
+		utilization[instance_type] = {'instances':instances_per_type[instance_type], 'samples':len(samples),
+									  'cpu_mean':mean(cpu), 'cpu_p95':percentile(cpu, 95),
+									  'memory_mean':mean(mem), 'memory_max':max(mem), 'engine_rss_mib_mean':mean(rss),
+									  'load_per_vcpu_mean':mean(load),
+									  'nfs_read_mibps_mean':mean(nfs_read), 'nfs_write_mibps_mean':mean(nfs_write),
+									  'cpu_busy_engines_mean':mean(busy)}
+	if hub_samples:
+		engines, busy, queued, unassigned, throughput = [list(column) for column in zip(*hub_samples)]
+		utilization['hub'] = {'samples':len(hub_samples), 'engines_mean':mean(engines), 'busy_engines_mean':mean(busy),
+							  'queued_mean':mean(queued), 'unassigned_mean':mean(unassigned), 'tasks_per_second_mean':mean(throughput)}
+
+	print('Engine utilization per instance type' + (' (last ' + str(since) + 'h)' if since is not None else ''))
+	for instance_type, u in sorted(utilization.items()):
+		if instance_type == 'hub':
+			continue
+		print('\t' + instance_type.rjust(18) + ': ' + str(u['instances']) + ' instance(s), ' + str(u['samples']) + ' samples')
+		print('\t' + 'CPU'.rjust(18) + ': ' + str(round(100*u['cpu_mean'], 1)) + '% mean, ' + str(round(100*u['cpu_p95'], 1)) + '% p95')
+		print('\t' + 'Memory'.rjust(18) + ': ' + str(round(100*u['memory_mean'], 1)) + '% mean, ' + str(round(100*u['memory_max'], 1)) + '% max, ' 
+			  + str(round(u['engine_rss_mib_mean'], 1)) + ' MiB RSS/engine')
+		print('\t' + 'Load/vCPU'.rjust(18) + ': ' + str(round(u['load_per_vcpu_mean'], 2)))
+		print('\t' + 'NFS'.rjust(18) + ': ' + str(round(u['nfs_read_mibps_mean'], 2)) + ' MiB/s read, ' + str(round(u['nfs_write_mibps_mean'], 2)) + ' MiB/s write')
+		print('\t' + 'CPU-busy engines'.rjust(18) + ': ' + str(round(100*u['cpu_busy_engines_mean'], 1)) + '% (using > half a core)')
+	if 'hub' in utilization:
+		u = utilization['hub']
+		print('\t' + 'Hub'.rjust(18) + ': ' + str(u['samples']) + ' samples')
+		print('\t' + 'Engines'.rjust(18) + ': ' + str(round(u['engines_mean'], 1)) + ' mean, ' + str(round(100*u['busy_engines_mean'], 1)) + '% running a task')
+		print('\t' + 'Waiting tasks'.rjust(18) + ': ' + str(round(u['queued_mean'], 1)) + ' queued on engines, ' + str(round(u['unassigned_mean'], 1)) + ' unassigned')
+		print('\t' + 'Throughput'.rjust(18) + ': ' + str(round(u['tasks_per_second_mean'], 2)) + ' tasks/s')
+
+	return utilization
+
+def cluster_status(resources_file_or_dict):
+	''' Print and return the state of the controller instance, the spot fleet and the SSH transport.'''
+	import boto3
+
+	cluster = _load_cluster_resources(resources_file_or_dict)
+	ec2 = boto3.client('ec2', region_name=cluster['region'])
+	status = dict()
 
+	print('Cluster ' + cluster['name'] + ' (' + cluster['region'] + ')')
+	try:
+		state = ec2.describe_instances(InstanceIds=[cluster['controller_instance_id']])['Reservations'][0]['Instances'][0]['State']
+		status['controller'] = state['Name']
+	except Exception as e:
+		status['controller'] = 'NotFound' if 'NotFound' in str(e) else str(e)
+	print('\t' + 'Controller'.rjust(18) + ': ' + status['controller'] + ' (' + cluster.get('controller_public_ip', '?') + ')')
+
+	if 'spot_fleet_request_id' in cluster:
+		try:
+			fleet = ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[cluster['spot_fleet_request_id']])['SpotFleetRequestConfigs'][0]
+			status['fleet'] = fleet['SpotFleetRequestState']
+			status['fleet_capacity'] = (fleet['SpotFleetRequestConfig'].get('FulfilledCapacity', 0.0), fleet['SpotFleetRequestConfig']['TargetCapacity'])
+			instances = ec2.describe_spot_fleet_instances(SpotFleetRequestId=cluster['spot_fleet_request_id'])['ActiveInstances']
+			status['fleet_instances'] = dict()
+			for instance in instances:
+				status['fleet_instances'][instance['InstanceType']] = status['fleet_instances'].get(instance['InstanceType'], 0) + 1
+		except Exception as e:
+			status['fleet'] = 'NotFound' if 'NotFound' in str(e) else str(e)
+		print('\t' + 'Spot fleet'.rjust(18) + ': ' + status['fleet'], end='')
+		if 'fleet_capacity' in status:
+			print(', ' + str(status['fleet_capacity'][0]) + '/' + str(status['fleet_capacity'][1]) + ' vCPU', end='')
+		print('')
+		for instance_type, nb in sorted(status.get('fleet_instances', {}).items()):
+			print('\t' + instance_type.rjust(18) + ': ' + str(nb))
+
+	if 'controller_public_ip' in cluster:
+		status['ssh_transport'] = ssh_transport_alive(cluster)
+		print('\t' + 'SSH transport'.rjust(18) + ': ' + ('up' if status['ssh_transport'] else 'down'))
+
+	return status
 
 def dismantle_cluster(resources_file_or_dict, keep_ebsdata_volume=True):
-	if type(resources_file_or_dict) == str:
-		with open(resources_file_or_dict, 'r') as f:
-			cluster = json.load(f)
-	elif (type(resources_file_or_dict) == dict):
-		if not 'name' in resources_file_or_dict:
-			raise Exception('Passed dictionary doesn\'t look like anything to me.')
-		cluster = resources_file_or_dict
-	else:
-		raise Exception(resources_file_or_dict + ' doesn\'t look like anything to me.')
+	import boto3
+
+	cluster = _load_cluster_resources(resources_file_or_dict)
 
 	ec2 = boto3.client('ec2', region_name=cluster['region'])
 
@@ -652,7 +1562,8 @@ def _tag_cluster_res(client, cluster_name, resource_ids, resource_type):
 
 def generate_simplified_price_list():
 	''' Download Amazon's price list and generate simplified list for OnDemand Linux instances.'''
-	pricing_url_prefix = 'https://pricing.us-east-1.amazonaws.com'
+	import requests
+
 	print('Getting latest offers...', end='')
 	offers = requests.get(pricing_url_prefix + '/offers/v1.0/aws/index.json')
 	offers = offers.json()
@@ -690,6 +1601,8 @@ def generate_simplified_price_list():
 	return simplified_price_dict
 
 def generate_spot_bid_per_vcpu(instance_types_weights, simplified_price_file_or_dict=None, region='us-east-1', bid_style='cheap', cheap_factor=1.5, cheap_percentile=75):
+	import boto3
+	from numpy import percentile
 
 	if type(simplified_price_file_or_dict) == str:
 		with open(simplified_price_file_or_dict, 'r') as f:
@@ -781,7 +1694,54 @@ def instance_launch_specifications(image_id, instance_type, subnet_ids, security
 	return specs
 
 def main():
-	pass
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Bork an ipyparallel cluster out of an EC2 spot fleet.')
+	subparsers = parser.add_subparsers(dest='command', metavar='{create,dismantle,status,bid,prices}')
+	subparsers.required = True
+
+	create = subparsers.add_parser('create', help='create a cluster (see create_cluster)')
+	create.add_argument('-n', '--name', default='bork', help='cluster name (default: bork)')
+	create.add_argument('-c', '--cores', type=int, default=8, help='target number of vCPU in the spot fleet (default: 8)')
+	create.add_argument('-r', '--region', default='ca-central-1', help='cluster region (default: ca-central-1)')
+	create.add_argument('-z', '--zone', default=None, help='controller+EBS availability zone (default: random)')
+	create.add_argument('--bid-style', choices=['cheap', 'automatic'], default='cheap')
+	create.add_argument('--cheap-factor', type=float, default=1.5)
+
+	dismantle = subparsers.add_parser('dismantle', help='dismantle a cluster (see dismantle_cluster)')
+	dismantle.add_argument('resources', help='<name>_ClusterResources.json, or just the cluster name')
+	dismantle.add_argument('--delete-ebsdata', action='store_true', help='also delete the EBS data volume')
+
+	status = subparsers.add_parser('status', help='state of the controller, spot fleet and SSH transport')
+	status.add_argument('resources', help='<name>_ClusterResources.json, or just the cluster name')
+
+	bid = subparsers.add_parser('bid', help='spot bid advice per vCPU (see generate_spot_bid_per_vcpu)')
+	bid.add_argument('-r', '--region', default='ca-central-1', help='region (default: ca-central-1)')
+	bid.add_argument('--bid-style', choices=['cheap', 'automatic'], default='cheap')
+	bid.add_argument('--cheap-factor', type=float, default=1.5)
+	bid.add_argument('--price-list', default='simplified_price_list.json', help='simplified OnDemand price list (default: simplified_price_list.json)')
+
+	subparsers.add_parser('prices', help='download the OnDemand price list into simplified_price_list.json')
+
+	args = parser.parse_args()
+
+	if args.command in ('dismantle', 'status') and not os.path.isfile(args.resources):
+		args.resources = args.resources + '_ClusterResources.json'
+
+	if args.command == 'create':
+		create_cluster(cluster_name=args.name, target_number_of_cores=args.cores, bid_style=args.bid_style, cheap_factor=args.cheap_factor, 
+					   cluster_region=args.region, controller_availability_zone=args.zone)
+	elif args.command == 'dismantle':
+		dismantle_cluster(args.resources, keep_ebsdata_volume=not args.delete_ebsdata)
+	elif args.command == 'status':
+		cluster_status(args.resources)
+	elif args.command == 'bid':
+		max_bid_advice, bid_advices = generate_spot_bid_per_vcpu(cx_fleet_weight, args.price_list, args.region, bid_style=args.bid_style, cheap_factor=args.cheap_factor)
+		print('Max spot price bid: ' + max_bid_advice)
+		for inst, spot in sorted(bid_advices.items(), key=lambda x: x[1]):
+			print('\t' + inst.rjust(18) + ': ' + spot)
+	elif args.command == 'prices':
+		generate_simplified_price_list()
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
@@ -34,3 +34,10 @@ service nfs start
 IP=$(ifconfig eth0 | grep 'inet addr' | cut -d: -f2 | awk '{{print $1}}')
 sudo -i -u ec2-user ipython profile create --parallel --profile-dir={ebsdata_mount_point}/profile_{cluster_name}
 sudo -i -u ec2-user ipcluster start --profile-dir={ebsdata_mount_point}/profile_{cluster_name} --ip=$IP --n=0 --daemonize=True
+
+## Start hub telemetry sampler, it appends the hub's task counts to {ebsdata_mount_point}/telemetry_{cluster_name}/hub.jsonl
+mkdir -p /opt/borkacluster
+cat > /opt/borkacluster/ipengine_telemetry.py <<'END_OF_TELEMETRY_AGENT'
+{telemetry_agent}
+END_OF_TELEMETRY_AGENT
+sudo -i -u ec2-user nohup python /opt/borkacluster/ipengine_telemetry.py --hub {ebsdata_mount_point}/telemetry_{cluster_name} {ebsdata_mount_point}/profile_{cluster_name} > /dev/null 2>&1 &
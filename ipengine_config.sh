@@ -1,7 +1,7 @@
 #!/bin/bash
 
 yum update -y
-yum -y install git htop ntf4-acl-tools
+yum -y install git htop ntf4-acl-tools cachefilesd
 
 ## Install python deps
 sudo -u ec2-user bash -c "wget https://repo.continuum.io/miniconda/Miniconda2-latest-Linux-x86_64.sh -O \$HOME/miniconda.sh"
@@ -12,13 +12,26 @@ sudo -i -u ec2-user conda install -y ipyparallel dill boto3
 #sudo -i -u ec2-user conda install -y scipy h5py matplotlib sortedcontainers
 #sudo -i -u ec2-user conda install -y -c etetoolkit ete2
 
+## Cache NFS reads on the instance's local disk (FS-Cache, 'fsc' mount option below)
+chkconfig cachefilesd on
+service cachefilesd start
+
 ## Mount EBS data volume
 if [ ! -d {ebsdata_mount_point} ]
 then
 	mkdir {ebsdata_mount_point}
 fi
-echo {controller_ip}:/ {ebsdata_mount_point} nfs4 nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2 0 0 >> /etc/fstab
+echo {controller_ip}:/ {ebsdata_mount_point} nfs4 nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,fsc 0 0 >> /etc/fstab
 mount {ebsdata_mount_point}
 
+## Start telemetry agent, it appends batched samples to {ebsdata_mount_point}/telemetry_{cluster_name} on the controller
+mkdir -p /opt/borkacluster
+cat > /opt/borkacluster/ipengine_telemetry.py <<'END_OF_TELEMETRY_AGENT'
+{telemetry_agent}
+END_OF_TELEMETRY_AGENT
+INSTANCE_ID=$(curl -s http://169.254.169.254/latest/meta-data/instance-id)
+INSTANCE_TYPE=$(curl -s http://169.254.169.254/latest/meta-data/instance-type)
+sudo -u ec2-user nohup python /opt/borkacluster/ipengine_telemetry.py {ebsdata_mount_point}/telemetry_{cluster_name} $INSTANCE_ID $INSTANCE_TYPE {ebsdata_mount_point} > /dev/null 2>&1 &
+
 ## Start ipcluster controller
 sudo -i -u ec2-user ipcluster engines --profile-dir={ebsdata_mount_point}/profile_{cluster_name} --daemonize=True
@@ -0,0 +1,168 @@
+""" Cluster telemetry agent, installed and started by ipengine_config.sh and ipcontroller_config.sh.
+
+On every engine instance it samples CPU, memory, engine RSS, load and NFS traffic on the data mount
+every interval seconds, and every flush seconds appends the batch to <telemetry_dir>/<instance id>.jsonl
+on the controller's NFS volume. cpu_busy_engines counts the engines that burnt more than half a core
+over the interval: a CPU proxy that sees I/O-bound tasks (e.g. waiting on NFS) as idle.
+
+With --hub it runs on the controller instead and records the hub's exact task counts (queue_status)
+to <telemetry_dir>/hub.jsonl: engines registered, engines with a task, tasks waiting behind them,
+tasks not yet assigned to an engine and tasks completed over the interval.
+
+The first line of each file is a header naming the record fields, then one compact JSON array per sample.
+
+	python ipengine_telemetry.py telemetry_dir instance_id instance_type [mount_point] [interval] [flush]
+	python ipengine_telemetry.py --hub telemetry_dir profile_dir [interval] [flush]
+
+Engine instance sampling only uses the standard library, so it runs on whatever python the AMI ships.
+The hub sampler needs ipyparallel.
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+fields = ['t', 'cpu', 'mem_used', 'mem_total', 'engine_rss', 'load1', 'nfs_read', 'nfs_write', 'engines', 'cpu_busy_engines']
+hub_fields = ['t', 'engines', 'busy_engines', 'queued', 'unassigned', 'completed']
+
+def cpu_times():
+	with open('/proc/stat', 'r') as f:
+		values = [int(v) for v in f.readline().split()[1:]]
+	## idle + iowait
+	return sum(values), values[3] + values[4]
+
+def memory():
+	meminfo = dict()
+	with open('/proc/meminfo', 'r') as f:
+		for line in f:
+			key, value = line.split(':', 1)
+			meminfo[key] = int(value.split()[0])*1024
+	available = meminfo.get('MemAvailable', meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0))
+	return meminfo['MemTotal'] - available, meminfo['MemTotal']
+
+def load1():
+	with open('/proc/loadavg', 'r') as f:
+		return float(f.read().split()[0])
+
+def nfs_bytes(mount_point):
+	''' Cumulative bytes read and written through the NFS mount, from /proc/self/mountstats.'''
+	mounted = False
+	with open('/proc/self/mountstats', 'r') as f:
+		for line in f:
+			if line.startswith('device '):
+				mounted = (' mounted on ' + mount_point + ' with fstype nfs') in line
+			elif mounted and line.strip().startswith('bytes:'):
+				values = [int(v) for v in line.split()[1:]]
+				## normal + direct reads, normal + direct writes
+				return values[0] + values[2], values[1] + values[3]
+	return 0, 0
+
+def engine_processes():
+	''' {pid: (cpu ticks, rss bytes)} of every ipengine process on the instance.'''
+	page_size = os.sysconf('SC_PAGE_SIZE')
+	processes = dict()
+	for pid in os.listdir('/proc'):
+		if not pid.isdigit():
+			continue
+		try:
+			with open('/proc/' + pid + '/cmdline', 'rb') as f:
+				cmdline = f.read()
+			if (not b'ipengine' in cmdline and not b'ipyparallel.engine' in cmdline) or b'ipengine_telemetry' in cmdline:
+				continue
+			with open('/proc/' + pid + '/stat', 'r') as f:
+				stat = f.read().rsplit(')', 1)[1].split()
+			## utime, stime and rss are fields 14, 15 and 24 of /proc/<pid>/stat
+			processes[int(pid)] = (int(stat[11]) + int(stat[12]), int(stat[21])*page_size)
+		except (IOError, OSError, IndexError):
+			continue
+	return processes
+
+def sample(mount_point, interval):
+	total_0, idle_0 = cpu_times()
+	engines_0 = engine_processes()
+	nfs_read_0, nfs_write_0 = nfs_bytes(mount_point)
+	time.sleep(interval)
+	total_1, idle_1 = cpu_times()
+	engines_1 = engine_processes()
+	nfs_read_1, nfs_write_1 = nfs_bytes(mount_point)
+
+	mem_used, mem_total = memory()
+	ticks = interval*os.sysconf('SC_CLK_TCK')
+	## CPU proxy: an engine running a CPU-bound task burns at least half a core
+	busy = sum([1 for pid, (cpu, rss) in engines_1.items() if pid in engines_0 and cpu - engines_0[pid][0] > 0.5*ticks])
+
+	return [int(time.time()), round(1.0 - float(idle_1 - idle_0)/max(total_1 - total_0, 1), 3),
+			mem_used, mem_total, sum([rss for cpu, rss in engines_1.values()]), load1(),
+			nfs_read_1 - nfs_read_0, nfs_write_1 - nfs_write_0, len(engines_1), busy]
+
+class HubSampler(object):
+	''' Exact task counts from the hub, through an ipyparallel client on the controller.'''
+	def __init__(self, profile_dir):
+		from ipyparallel import Client
+
+		## ipcluster --daemonize returns before the controller wrote its connection files
+		client_file = os.path.join(profile_dir, 'security', 'ipcontroller-client.json')
+		while not os.path.isfile(client_file):
+			time.sleep(5)
+		self.client = Client(client_file)
+		self.completed = None
+
+	def sample(self, interval):
+		time.sleep(interval)
+		status = self.client.queue_status()
+		unassigned = status.pop('unassigned', 0)
+		## Per engine, queue counts direct requests and tasks load balanced ones, the running one included
+		pending = [s['queue'] + s['tasks'] for s in status.values()]
+		completed = sum([s['completed'] for s in status.values()])
+		## Engines that left take their completed count with them
+		completed_delta = max(completed - self.completed, 0) if self.completed is not None else 0
+		self.completed = completed
+		busy = sum([1 for p in pending if p > 0])
+		return [int(time.time()), len(pending), busy, sum(pending) - busy, unassigned, completed_delta]
+
+def main():
+	if sys.argv[1] == '--hub':
+		telemetry_dir, profile_dir = sys.argv[2:4]
+		interval = float(sys.argv[4]) if len(sys.argv) > 4 else 10
+		flush = float(sys.argv[5]) if len(sys.argv) > 5 else 60
+		file_name = 'hub.jsonl'
+		header = {'hub':True, 'interval':interval, 'fields':hub_fields}
+		hub = HubSampler(profile_dir)
+		sampler = lambda: hub.sample(interval)
+	else:
+		telemetry_dir, instance_id, instance_type = sys.argv[1:4]
+		mount_point = sys.argv[4] if len(sys.argv) > 4 else '/ebsdata'
+		interval = float(sys.argv[5]) if len(sys.argv) > 5 else 10
+		flush = float(sys.argv[6]) if len(sys.argv) > 6 else 60
+		file_name = instance_id + '.jsonl'
+		header = {'instance_id':instance_id, 'instance_type':instance_type, 'vcpus':os.sysconf('SC_NPROCESSORS_ONLN'),
+				  'interval':interval, 'fields':fields}
+		sampler = lambda: sample(mount_point, interval)
+
+	if not os.path.isdir(telemetry_dir):
+		try:
+			os.makedirs(telemetry_dir)
+		except OSError:
+			pass
+	telemetry_file = os.path.join(telemetry_dir, file_name)
+	if not os.path.isfile(telemetry_file):
+		with open(telemetry_file, 'w') as f:
+			f.write(json.dumps(header) + '\n')
+
+	batch = []
+	last_flush = time.time()
+	while True:
+		batch.append(json.dumps(sampler(), separators=(',', ':')))
+		if time.time() - last_flush >= flush:
+			## One append per flush keeps the NFS server out of the sampling loop
+			try:
+				with open(telemetry_file, 'a') as f:
+					f.write('\n'.join(batch) + '\n')
+				batch = []
+			except (IOError, OSError):
+				pass
+			last_flush = time.time()
+
+if __name__ == '__main__':
+	main()